@@ -1,36 +1,74 @@
 import sys
 import os
 import pythoncom
+from functools import lru_cache
 
 ESAPI_PATH = os.environ.get('ESAPI_PATH')
+PATHS_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".pyesapi_paths")  # found library paths, one per line
+
+ESAPI_VERSIONS = ["15.5", "15.6"]
+ESAPI_DRIVES = ["C:", "D:"]  # Could potentially list local drives, but Eclispe should be on C or D
+
+
+def _version_paths(drive, ver):
+    '''returns the two library paths of an ESAPI version installed on drive'''
+    rpaths = [os.path.join("esapi", "API"), "ExternalBeam"]
+    base = os.path.join("Program Files (x86)", "Varian", "RTM")
+    return [os.path.join(drive, os.sep, base, ver, rp) for rp in rpaths]
+
+
+def _read_cached_paths():
+    '''returns the paths in PATHS_CACHE_FILE if they still exist and belong to a searched version, else None'''
+    try:
+        with open(PATHS_CACHE_FILE) as f:
+            paths = f.read().splitlines()
+    except OSError:
+        return None
+
+    searched = [_version_paths(drive, ver) for drive in ESAPI_DRIVES for ver in ESAPI_VERSIONS]
+    if paths in searched and all(os.path.isdir(p) for p in paths):
+        return paths
+    return None
+
+
+def _search_paths():
+    '''returns the library paths of the first version found with both of them'''
+    for drive in ESAPI_DRIVES:
+        if not os.path.isdir(drive + os.sep):
+            continue  # skip probing all versions of a missing drive
+        for ver in ESAPI_VERSIONS:
+            paths = _version_paths(drive, ver)
+            if all(os.path.isdir(p) for p in paths):
+                return paths
+
+    spaths = [p for drive in ESAPI_DRIVES for ver in ESAPI_VERSIONS for p in _version_paths(drive, ver)]
+    raise Exception("Did not find required library paths!  Searched for:\n %s" % (",\n".join(spaths)))
+
+
+def _write_cached_paths(paths):
+    '''saves paths to PATHS_CACHE_FILE for later imports'''
+    try:
+        with open(PATHS_CACHE_FILE, 'w') as f:
+            f.write("\n".join(paths))
+    except OSError:
+        pass  # caching is optional
+
+
+@lru_cache(maxsize=None)
+def _discover_paths():
+    '''returns the ESAPI library paths, read from PATHS_CACHE_FILE if still valid, else searched for (and cached)'''
+    paths = _read_cached_paths()
+    if paths is None:
+        paths = _search_paths()
+        _write_cached_paths(paths)
+    return paths
+
 
 if ESAPI_PATH is not None:
     # optionally set ESAPI_PATH env var with location of DLLs
     sys.path.append(ESAPI_PATH)
 else:
-    # do some soul searching
-    rpaths = [os.path.join("esapi", "API"), "ExternalBeam"]
-    versions = ["15.5", "15.6"]
-    base = os.path.join("Program Files (x86)", "Varian", "RTM")
-    drives = ["C:", "D:"]  # Could potentially list local drives, but Eclispe should be on C or D
-
-    # Add paths that exist
-    paths = []
-    spaths = []
-    for drive in drives:
-        for ver in versions:
-            for rp in rpaths:
-                p = os.path.join(drive, os.sep, base, ver, rp)
-                spaths.append(p)
-                if os.path.isdir(p):
-                    paths.append(p)
-
-    if len(paths) < 2:
-        raise Exception("Did not find required library paths!  Searched for:\n %s" % (",\n".join(spaths)))
-    if len(paths) > 2:
-        print("WARNING: Found multiple possible VMS dll locations:\n %s" % (",\n".join(spaths)))
-
-    for p in paths:
+    for p in _discover_paths():
         sys.path.append(p)
 
 import clr  # pip install git+https://github.com/VarianAPIs/pythonnet
@@ -75,98 +113,207 @@ else:
 
 # the python
 import numpy as np
-from ctypes import string_at, sizeof, c_int32, c_bool, c_double
-from scipy.ndimage.morphology import binary_dilation, binary_erosion
+from ctypes import string_at, sizeof, memmove, c_int32, c_uint8, c_float, c_double
+from contextlib import contextmanager
+from operator import attrgetter
+from scipy.ndimage import convolve, distance_transform_cdt, generate_binary_structure
 
 from .Lot import Lot
 
 SAFE_MODE = False  # if True all C# to Numpy array copies are verified
 
+BOUNDARY_CHUNK_SIZE = 1024  # boundary voxels sub-sampled at a time by make_segment_mask_for_grid(...)
+
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)  # set bits of every byte value
+
 def lot_lambda(attr):
     '''returns a lambda that wraps attr in a lot'''
-    return lambda self, key=None: Lot(getattr(self, attr)) if key is None else Lot(getattr(self, attr))[key]
+    get_attr = attrgetter(attr)  # resolved once, not on every call
+    return lambda self, key=None: Lot(get_attr(self)) if key is None else Lot(get_attr(self))[key]
 
 
-def lotify(T):
-    '''adds lot accessors to IEnumerable children'''
-    # TODO: add recursion
+@lru_cache(maxsize=None)
+def enumerable_property_names(T):
+    '''returns the names of the generic IEnumerable properties of T (reflection results are cached per type)'''
     ienum_t = System.Type.GetType('System.Collections.IEnumerable')
     t = System.Type.GetType(T.__module__ + '.' + T.__name__ + ',' + T.__module__)
+    names = []
     for p in t.GetProperties():
         # look for IEnumerable types
         if ienum_t.IsAssignableFrom(p.PropertyType) \
                 and p.PropertyType.IsGenericType \
                 and len(p.PropertyType.GetGenericArguments()) == 1:
-            # Monkeypatch the lot accessor onto the parent object
-            setattr(T, p.Name + "Lot", lot_lambda(p.Name))
+            names.append(p.Name)
+    return tuple(names)
 
 
-def to_ndarray(src, dtype):
-    '''converts a blitable .NET array of type dtype to a numpy array of type dtype'''
+def lotify(T):
+    '''adds lot accessors to IEnumerable children'''
+    # TODO: add recursion
+    for name in enumerable_property_names(T):
+        # Monkeypatch the lot accessor onto the parent object
+        setattr(T, name + "Lot", lot_lambda(name))
+
+
+@contextmanager
+def pinned(src):
+    '''pins a blitable .NET array for the duration of the with block, yields the address of its first element'''
     src_hndl = GCHandle.Alloc(src, GCHandleType.Pinned)
     try:
-        src_ptr = src_hndl.AddrOfPinnedObject().ToInt64()
-        dest = np.frombuffer(string_at(src_ptr, len(src) * sizeof(dtype)), dtype=dtype)
+        yield src_hndl.AddrOfPinnedObject().ToInt64()
     finally:
         if src_hndl.IsAllocated:
             src_hndl.Free()
+
+
+def to_ndarray(src, dtype):
+    '''converts a blitable .NET array of type dtype to a numpy array of type dtype'''
+    with pinned(src) as src_ptr:
+        dest = np.frombuffer(string_at(src_ptr, len(src) * sizeof(dtype)), dtype=dtype)
     if SAFE_MODE:
         check_arrays(src, dest)
     return dest
 
 
+@lru_cache(maxsize=None)
+def buffer_reader(length, dtype):
+    '''returns a function copying a pinned blitable .NET array (given its address) of length elements of type dtype
+       to a numpy array, specialized on length and dtype so the byte count is only computed once
+    '''
+    nbytes = length * sizeof(dtype)
+
+    def read(src_ptr):
+        return np.frombuffer(string_at(src_ptr, nbytes), dtype=dtype)
+    return read
+
+
+def from_ndarray(src, dest, dtype):
+    '''copies a numpy array into a blitable .NET array of type dtype (of same size) in a single memmove'''
+    src = np.ascontiguousarray(src, dtype=dtype)
+    assert src.nbytes == len(dest) * sizeof(dtype), "Arrays are different size!"
+    with pinned(dest) as dest_ptr:
+        memmove(dest_ptr, src.ctypes.data, src.nbytes)
+    if SAFE_MODE:
+        check_arrays(dest, src.ravel())
+    return dest
+
+
 def image_to_nparray(image_like):
-    '''returns a 3D numpy.ndarray of floats indexed like [x,y,z]'''
-    _shape = (image_like.XSize, image_like.YSize, image_like.ZSize)
-    _array = np.zeros(_shape)
+    '''returns a 3D numpy.ndarray of ints indexed like [x,y,z]'''
+    _array = np.empty((image_like.ZSize, image_like.XSize, image_like.YSize), dtype=np.int32)
+    slice_nbytes = image_like.XSize * image_like.YSize * sizeof(c_int32)
 
     _buffer = Array.CreateInstance(Int32, image_like.XSize, image_like.YSize)
-    for z in range(image_like.ZSize):
-        image_like.GetVoxels(z, _buffer)
-        _array[:, :, z] = to_ndarray(_buffer, dtype=c_int32).reshape((image_like.XSize, image_like.YSize))
+    with pinned(_buffer) as buffer_ptr:
+        for z in range(image_like.ZSize):
+            image_like.GetVoxels(z, _buffer)
+            # slices of _array are contiguous, copy straight into place
+            memmove(_array[z].ctypes.data, buffer_ptr, slice_nbytes)
+            if SAFE_MODE:
+                check_arrays(_buffer, _array[z].ravel())
 
-    return _array
+    return _array.transpose(1, 2, 0)  # [z,x,y] -> [x,y,z]
 
 
-def dose_to_nparray(dose):
-    '''returns a 3D numpy.ndarray of floats indexed like [x,y,z]'''
+def dose_to_nparray(dose, dtype=np.float64):
+    '''returns a 3D numpy.ndarray of floats indexed like [x,y,z]
+       dtype: numpy float type of the result, np.float32 halves memory and is enough for the int voxel precision (default: np.float64)
+    '''
     dose_array = image_to_nparray(dose)
 
-    scale = float(dose.VoxelToDoseValue(1).Dose - dose.VoxelToDoseValue(0).Dose)  # maps int to float
-    offset = float(
-        dose.VoxelToDoseValue(0).Dose) / scale  # minimum dose value stored as int (zero if coming from Eclipse plan)
-    return scale * dose_array.astype(float) + offset
+    zero_dose = float(dose.VoxelToDoseValue(0).Dose)
+    scale = float(dose.VoxelToDoseValue(1).Dose) - zero_dose  # maps int to float
+    offset = zero_dose / scale  # minimum dose value stored as int (zero if coming from Eclipse plan)
+
+    # scale straight from the int voxels into one float volume, no intermediate copies
+    out = np.empty(dose_array.shape, dtype=dtype)
+    np.multiply(dose_array, scale, out=out, dtype=dtype)
+    out += offset
+    return out
+
+
+def vvector_to_nparray(vv):
+    '''returns a VVector as a numpy.ndarray of 3 floats'''
+    return np.array([vv.x, vv.y, vv.z])
 
 
 def fill_in_profiles(dose_or_image, profile_fxn, row_buffer, dtype, pre_buffer=None):
-    '''fills in 3D profile data (dose or segments)'''
-    mask_array = np.zeros((dose_or_image.XSize, dose_or_image.YSize, dose_or_image.ZSize))
+    '''fills in 3D profile data (dose or segments)
+       pre_buffer: BitArray profile buffer, if given row_buffer must be a Byte[] of length (ZSize + 7) // 8 and dtype c_uint8
+    '''
+    # grid properties are CLR calls, read them once rather than per profile
+    x_size, y_size, z_size = dose_or_image.XSize, dose_or_image.YSize, dose_or_image.ZSize
+    mask_array = np.zeros((x_size, y_size, z_size))
+
+    # start points of every profile, indexed like [x,y,(x,y,z)]
+    x_step = dose_or_image.XRes * vvector_to_nparray(dose_or_image.XDirection)
+    y_step = dose_or_image.YRes * vvector_to_nparray(dose_or_image.YDirection)
+    starts = vvector_to_nparray(dose_or_image.Origin) \
+        + np.arange(x_size)[:, None, None] * x_step \
+        + np.arange(y_size)[None, :, None] * y_step
 
     # note used ZSize-1 to match zero indexed loops below and compute_voxel_points_matrix(...)
-    z_direction = VVector.op_Multiply(Double((dose_or_image.ZSize - 1) * dose_or_image.ZRes), dose_or_image.ZDirection)
-    y_step = VVector.op_Multiply(dose_or_image.YRes, dose_or_image.YDirection)
+    z_direction = (z_size - 1) * dose_or_image.ZRes * vvector_to_nparray(dose_or_image.ZDirection)
+    stops = starts + z_direction
+
+    read_row_buffer = buffer_reader(len(row_buffer), dtype)
+
+    # the row buffer is reused for every profile, pin it once for the whole scan
+    with pinned(row_buffer) as row_ptr:
+        for x in range(x_size):  # scan X dimensions
+            # plain python floats are cheapest to hand to VVector, converted one row at a time
+            for y, (start, stop) in enumerate(zip(starts[x].tolist(), stops[x].tolist())):  # scan Y dimension
+                start = VVector(*start)
+                stop = VVector(*stop)
+
+                # get the profile along Z dimension
+                if pre_buffer is None:
+                    profile_fxn(start, stop, row_buffer)
+                else:
+                    profile_fxn(start, stop, pre_buffer)
+                    pre_buffer.CopyTo(row_buffer, 0)
+
+                row = read_row_buffer(row_ptr)
+                if SAFE_MODE:
+                    check_arrays(row_buffer, row)
+
+                # save data
+                if pre_buffer is None:
+                    mask_array[x, y, :] = row
+                else:
+                    # BitArray packs 8 bits per byte, lowest index in the lowest bit
+                    mask_array[x, y, :] = np.unpackbits(row, bitorder='little')[:z_size]
 
-    for x in range(dose_or_image.XSize):  # scan X dimensions
-        start_x = VVector.op_Addition(dose_or_image.Origin,
-                                      VVector.op_Multiply(Double(x * dose_or_image.XRes), dose_or_image.XDirection))
+    return mask_array
 
-        for y in range(dose_or_image.YSize):  # scan Y dimension
-            stop = VVector.op_Addition(start_x, z_direction)
 
-            # get the profile along Z dimension 
-            if pre_buffer is None:
-                profile_fxn(start_x, stop, row_buffer)
-            else:
-                profile_fxn(start_x, stop, pre_buffer)
-                pre_buffer.CopyTo(row_buffer, 0)  # is this really needed?
+def count_segment_samples(structure, centers, resolution, sub_samples):
+    '''returns, for each voxel center, the number of its sub_samples**3 sample points inside the structure segment'''
+    xRes, yRes, zRes = resolution
 
-            # save data
-            mask_array[x, y, :] = to_ndarray(row_buffer, dtype)
+    # rays (sub samples in x and y, each ray samples z), indexed like [voxel,xf,yf,(x,y,z start,z stop)]
+    rays = np.empty((len(centers), sub_samples, sub_samples, 4))
+    rays[..., 0] = centers[:, 0, None, None] + np.linspace(-0.5 * xRes, 0.5 * xRes, sub_samples)[None, :, None]
+    rays[..., 1] = centers[:, 1, None, None] + np.linspace(-0.5 * yRes, 0.5 * yRes, sub_samples)[None, None, :]
+    rays[..., 2] = centers[:, 2, None, None] - 0.5 * zRes
+    rays[..., 3] = centers[:, 2, None, None] + 0.5 * zRes
 
-            # add step for next point
-            start_x = VVector.op_Addition(start_x, y_step)
+    # issue all profile calls in one flat loop, everything else is done in numpy before and after
+    inside = System.Collections.BitArray(sub_samples)
+    inside_bytes = Array.CreateInstance(System.Byte, (sub_samples + 7) // 8)
+    inside_nbytes = len(inside_bytes)
+    ray_bytes = np.empty((len(centers), sub_samples**2, inside_nbytes), dtype=np.uint8)
+    ray_ptr = ray_bytes.ctypes.data
+    with pinned(inside_bytes) as inside_ptr:
+        for x, y, z_start, z_stop in rays.reshape(-1, 4).tolist():
+            structure.GetSegmentProfile(VVector(x, y, z_start), VVector(x, y, z_stop), inside)
+            inside.CopyTo(inside_bytes, 0)
+            memmove(ray_ptr, inside_ptr, inside_nbytes)
+            ray_ptr += inside_nbytes
 
-    return mask_array
+    # count set bits of all rays at once with a byte lookup table, ignoring padding bits of the last byte
+    ray_bytes[..., -1] &= (1 << (sub_samples - 8 * (inside_nbytes - 1))) - 1
+    return POPCOUNT[ray_bytes].sum(axis=(1, 2), dtype=np.uint16)
 
 
 def make_segment_mask_for_grid(structure, dose_or_image, sub_samples = None):
@@ -180,60 +327,61 @@ def make_segment_mask_for_grid(structure, dose_or_image, sub_samples = None):
     else:
         assert type(sub_samples) == int, "sub_samples must be an integer"
         assert sub_samples > 1, "sub_samples must be > 1"
+        assert sub_samples**3 <= np.iinfo(np.uint16).max, "sub_samples must be <= 40"
         # compute fractional voxels at boundary
 
-        mask_dilated = binary_dilation(mask)
-        mask_eroded = binary_erosion(mask)
+        # one convolution with the (cross) structuring element counts set neighbors, giving both the dilation (any)
+        # and erosion (all), zero padding matches the default border_value of binary_dilation/binary_erosion
+        structure_element = generate_binary_structure(3, 1).astype(np.uint8)
+        neighbors = convolve((mask != 0).view(np.uint8), structure_element, mode='constant', cval=0)
+        mask_dilated = neighbors > 0
+        mask_eroded = neighbors == structure_element.sum()
         mask_boundary = mask_dilated ^ mask_eroded
         nsamples = sub_samples**3
         boundary_idx = np.where(mask_boundary)
 
-        mask_partials = np.zeros_like(mask, dtype=float)
-        xRes, yRes, zRes = dose_or_image.XRes, dose_or_image.YRes, dose_or_image.ZRes
-        
-        for ix, iy, iz in zip(boundary_idx[0],boundary_idx[1],boundary_idx[2]):
-
-            x = dose_or_image.Origin.x + ix * xRes
-            y = dose_or_image.Origin.y + iy * yRes
-            z = dose_or_image.Origin.z + iz * zRes
+        resolution = np.array([dose_or_image.XRes, dose_or_image.YRes, dose_or_image.ZRes])
+        origin = vvector_to_nparray(dose_or_image.Origin)
 
-            f = 0
-            for xf in np.linspace(-0.5*xRes,0.5*xRes,sub_samples):
-                for yf in np.linspace(-0.5*yRes,0.5*yRes,sub_samples):
-                    start = VVector(x + xf, y + yf, z - 0.5 * zRes)
-                    stop  = VVector(x + xf, y + yf, z + 0.5 * zRes )
-                    inside = System.Collections.BitArray(sub_samples)
-                    structure.GetSegmentProfile(start, stop, inside)
-                    for b in inside:
-                        if b:
-                            f += 1
-            mask_partials[ix,iy,iz] = f/nsamples
+        # accumulate integer counts per voxel, divide once at the end
+        counts = np.zeros(mask.shape, dtype=np.uint16)
+        # process boundary voxels in chunks, keeps memory for the rays bounded
+        for chunk in range(0, len(boundary_idx[0]), BOUNDARY_CHUNK_SIZE):
+            chunk_idx = tuple(idx[chunk:chunk + BOUNDARY_CHUNK_SIZE] for idx in boundary_idx)
+            centers = origin + np.stack(chunk_idx, axis=-1) * resolution
+            counts[chunk_idx] = count_segment_samples(structure, centers, resolution, sub_samples)
 
-        return mask_partials + mask_eroded
+        mask_partials = counts.astype(np.float32)
+        mask_partials /= nsamples
+        mask_partials += mask_eroded
+        return mask_partials
 
 
 def make_segment_mask_for_structure(dose_or_image, structure):
     '''returns a 3D numpy.ndarray of bools matching dose or image grid indexed like [x,y,z]'''
     if (structure.HasSegment):
         pre_buffer = System.Collections.BitArray(dose_or_image.ZSize)
-        row_buffer = Array.CreateInstance(bool, dose_or_image.ZSize)
+        row_buffer = Array.CreateInstance(System.Byte, (dose_or_image.ZSize + 7) // 8)
 
-        return fill_in_profiles(dose_or_image, structure.GetSegmentProfile, row_buffer, c_bool, pre_buffer)
+        return fill_in_profiles(dose_or_image, structure.GetSegmentProfile, row_buffer, c_uint8, pre_buffer)
     else:
         raise Exception("structure has no segment data")
 
 
-def make_dose_for_grid(dose, image=None):
-    '''returns a 3D numpy.ndarray of doubles matching dose (default) or image grid indexed like [x,y,z]'''
+def make_dose_for_grid(dose, image=None, dtype=np.float64):
+    '''returns a 3D numpy.ndarray of doubles matching dose (default) or image grid indexed like [x,y,z]
+       dtype: numpy float type of the result, see dose_to_nparray(...) (default: np.float64)
+    '''
 
     if image is not None:
         row_buffer = Array.CreateInstance(Double, image.ZSize)
         dose_array = fill_in_profiles(image, dose.GetDoseProfile, row_buffer, c_double)
+        dose_array = dose_array.astype(dtype, copy=False)
     else:
         # default
-        dose_array = dose_to_nparray(dose)
+        dose_array = dose_to_nparray(dose, dtype)
 
-    dose_array[np.where(np.isnan(dose_array))] = 0.0
+    np.copyto(dose_array, 0.0, where=np.isnan(dose_array))  # in place, only NaN (not inf) is replaced
     return dose_array
 
 
@@ -253,11 +401,14 @@ def compute_voxel_points_matrix(dose_or_image):
             endpoint=True
         ))
 
-    # create a matrix of 3-vectors for voxel locations
-    voxel_points = np.vstack((np.meshgrid(*ax, indexing='ij'))).reshape(3, *_shape).T
-    voxel_points = np.swapaxes(voxel_points, 0, 2)  # gets us to [x,y,z]
-    assert np.all(origin == voxel_points[0, 0, 0])
-    assert np.all(origin + (np.array(_shape) - 1) * np.array(resolution) == voxel_points[-1, -1, -1])
+    # create a matrix of 3-vectors for voxel locations, filled by broadcasting each axis
+    voxel_points = np.empty((*_shape, 3))
+    voxel_points[..., 0] = ax[0][:, None, None]
+    voxel_points[..., 1] = ax[1][None, :, None]
+    voxel_points[..., 2] = ax[2][None, None, :]
+    if SAFE_MODE:
+        assert np.all(origin == voxel_points[0, 0, 0])
+        assert np.all(origin + (np.array(_shape) - 1) * np.array(resolution) == voxel_points[-1, -1, -1])
     return voxel_points
 
 
@@ -275,9 +426,8 @@ def set_fluence_nparray(beam, shaped_fluence, beamlet_size_mm=2.5):
     x_origin = - float(shaped_fluence.shape[0] - 1) * beamlet_size_mm / 2.0
     y_origin = + float(shaped_fluence.shape[1] - 1) * beamlet_size_mm / 2.0
 
-    for i in range(shaped_fluence.shape[0]):
-        for j in range(shaped_fluence.shape[1]):
-            _buffer[i, j] = shaped_fluence[i, j]
+    # .NET multidimensional arrays are row major, same as a C-contiguous numpy array
+    from_ndarray(shaped_fluence, _buffer, c_float)
 
     fluence = Fluence(_buffer, x_origin, y_origin)
     beam.SetOptimalFluence(fluence)
@@ -316,29 +466,63 @@ IonBeam.GetEditableIonBeamParameters = get_editable_IonBeamParameters
 
 ## some tests ##
 
-def validate_structure_mask(structure, mask, pts, margin=4):
-    dilation_idx = np.where(binary_dilation(mask, iterations=margin))
-    flat_pts = pts[dilation_idx]
-    flat_mask = mask[dilation_idx]
-    vv = VVector(0. ,0. , 0.)
+def validate_structure_mask(structure, mask, pts, margin=4, use_profiles=False):
+    '''asserts mask matches structure within margin voxels of it, testing each point with IsPointInsideSegment
+       use_profiles: bool, test whole Z columns with GetSegmentProfile instead, faster but uses the same call as
+                     make_segment_mask_for_structure(...) so only catches indexing errors (default: False)
+    '''
+    # points within margin voxels (taxicab distance) of the mask, the same region as iterating a cross shaped
+    # binary_dilation margin times but in one distance transform (-1 means no mask voxel at all)
+    distance = distance_transform_cdt(mask == 0, metric='taxicab')
+    dilated = (distance >= 0) & (distance <= margin)
+
+    if use_profiles:
+        mismatch_count = count_profile_mismatches(structure, mask, pts, dilated)
+    else:
+        dilation_idx = np.where(dilated)
+        flat_pts = pts[dilation_idx]
+        flat_mask = mask[dilation_idx]
+        vv = VVector(0. ,0. , 0.)
+
+        def tester(pt):
+            vv.x = pt[0]
+            vv.y = pt[1]
+            vv.z = pt[2]
+            return structure.IsPointInsideSegment(vv)
+
+        mismatch_count = 0
+        for i, p in enumerate(flat_pts):
+            if flat_mask[i] != tester(p):
+                mismatch_count += 1
+
+    error = mismatch_count / np.count_nonzero(dilated) * 100.0
+    print("mask error (%):", error)
+    assert error <= 0.05, "Masking error greater than 0.05 %"
+
 
-    def tester(pt):
-        vv.x = pt[0]
-        vv.y = pt[1]
-        vv.z = pt[2]
-        return structure.IsPointInsideSegment(vv)
+def count_profile_mismatches(structure, mask, pts, tested):
+    '''returns the number of tested mask voxels that disagree with a segment profile along their Z column'''
+    z_size = mask.shape[2]
+    profile = System.Collections.BitArray(z_size)
+    profile_bytes = Array.CreateInstance(System.Byte, (z_size + 7) // 8)
 
     mismatch_count = 0
-    for i, p in enumerate(flat_pts):
-        if flat_mask[i] != tester(p):
-            mismatch_count += 1
+    for ix, iy in np.argwhere(tested.any(axis=2)).tolist():
+        start = VVector(*pts[ix, iy, 0].tolist())
+        stop = VVector(*pts[ix, iy, -1].tolist())
+        structure.GetSegmentProfile(start, stop, profile)
+        profile.CopyTo(profile_bytes, 0)
+        inside = np.unpackbits(to_ndarray(profile_bytes, c_uint8), bitorder='little')[:z_size]
 
-    error = mismatch_count / len(flat_mask) * 100.0
-    print("mask error (%):", error)
-    assert error <= 0.05, "Masking error greater than 0.05 %"
+        column = tested[ix, iy]
+        mismatch_count += np.count_nonzero(mask[ix, iy, column] != inside[column])
+    return mismatch_count
 
 
 def check_arrays(a, b):
-    '''array copy verification'''
-    assert len(a) == len(b), "Arrays are different size!"
-    assert any(A == B for A, B in zip(a, b)), "Arrays have different values!"
+    '''array copy verification, compares the memory of blitable .NET array a with numpy array b'''
+    assert len(a) == b.size, "Arrays are different size!"
+    with pinned(a) as a_ptr:
+        a_bytes = string_at(a_ptr, b.nbytes)
+    # byte comparison, so NaN values compare equal too
+    assert a_bytes == np.ascontiguousarray(b).tobytes(), "Arrays have different values!"